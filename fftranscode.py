@@ -8,17 +8,35 @@ import time
 import re
 import logging
 import signal
-from optparse import OptionParser
+import shlex
+import threading
+import queue
+import collections
+import argparse
+import json
+import shutil
+import tempfile
+
+FFMPEG_VER_RE = re.compile(rb'^ffmpeg version (\S+) ')
+# The stderr ring buffer keeps at most STDERR_LINES lines of STDERR_LINE_LEN
+# bytes, 64KB in all.
+STDERR_LINES = 256
+STDERR_LINE_LEN = 256
+LOG_FORMATTER = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
 class Base(object):
     def __init__(self):
         logger = logging.getLogger(self.__class__.__name__)
-        log_handler = logging.StreamHandler()
-        log_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
 
-        logger.addHandler(log_handler)
+        # Loggers are shared per class, only the first instance adds a handler
+        # so batches do not emit every line once per instance.
+        if not logger.handlers:
+            log_handler = logging.StreamHandler()
+            log_handler.setFormatter(LOG_FORMATTER)
 
-        logger.debug('Initialised logger.')
+            logger.addHandler(log_handler)
+
+            logger.debug('Initialised logger.')
 
         self.logger = logger
 
@@ -26,133 +44,271 @@ class Base(object):
         return '%s: %r' % (self.__class__.__name__, self.__dict__)
 
 def command_line_parser():
-    usage = 'usage: %prog [options]'
-    parser = OptionParser(usage)
+    usage = '%(prog)s [options]'
+    parser = argparse.ArgumentParser(usage = usage)
 
-    parser.add_option(
+    parser.add_argument(
         '-i',
         '--input-file',
-        dest='input_file',
+        dest='input_files',
         metavar='INPUT_FILE',
+        action='append',
+        default=[],
+        help='Input media file, may be given multiple times to transcode a batch (must be set) [default: "%(default)s"]'
+    )
+
+    parser.add_argument(
+        '-L',
+        '--input-list',
+        dest='input_list',
+        metavar='INPUT_LIST',
         default='',
-        help='Input media file (must be set) [default: "%default"]'
+        help='File listing input media files, one per line [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-o',
         '--ouput-file',
         dest='output_file',
         metavar='OUTPUT_FILE',
         default='',
-        help='Output media file, if unset generated based on codec options and input file [default: "%default"]'
+        help='Output media file, if unset generated based on codec options and input file [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-v',
         '--verbose',
         dest='verbose',
         action="store_true",
         default=False,
-        help='Turn on verbose logging [default: "%default"]'
+        help='Turn on verbose logging [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-N',
         '--not-nice',
         dest='not_nice',
         action="store_true",
         default=False,
-        help='Run not niced, i.e. normal scheduler priority [default: "%default"]'
+        help='Run not niced, i.e. normal scheduler priority [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-I',
         '--interactive',
         dest='interactive',
         action="store_true",
         default=False,
-        help='Run ffmpeg in interactive mode [default: "%default"]'
+        help='Run ffmpeg in interactive mode [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-c',
         '--codec',
         dest='codec',
         metavar='CODEC',
         default='libx264',
-        help='Video codec library to use [default: "%default"]'
+        help='Video codec library to use [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-p',
         '--profile',
         dest='profile',
         metavar='PROFILE',
         default='High',
-        help='Video codec profile to use [default: "%default"]'
+        help='Video codec profile to use [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-l',
         '--level',
         dest='level',
         metavar='LEVEL',
         default='6.2',
-        help='Video codec level to set [default: "%default"]'
+        help='Video codec level to set [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-r',
         '--preset',
         dest='preset',
         metavar='PRESET',
         default='9',
-        help='Video codec preset to use [default: "%default"]'
+        help='Video codec preset to use [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-f',
         '--crf',
         dest='crf',
         metavar='CRF',
         default='17',
-        help='Video codec constant rate factor (crf) to use [default: "%default"]'
+        help='Video codec constant rate factor (crf) to use [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-t',
         '--tune',
         dest='tune',
         metavar='TUNE',
         default='',
-        help='Video codec preset to use [default: "%default"]'
+        help='Video codec preset to use [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-e',
         '--extra',
         dest='extra',
         metavar='EXTRA',
         default='',
-        help='Extra args for ffmpeg [default: "%default"]'
+        help='Extra args for ffmpeg [default: "%(default)s"]'
     )
 
-    parser.add_option(
+    parser.add_argument(
         '-s',
         '--subprocess-out-file',
         dest='subprocess_out_file',
         metavar='SUBPROCESS_OUT_FILE',
         default='-',
-        help='File to redirect subprocess output to [default: "-" (stdout)]'
+        help='File to redirect subprocess output to, the last lines are also logged if ffmpeg fails [default: "-" (stdout)]'
+    )
+
+    parser.add_argument(
+        '-q',
+        '--quiet',
+        dest='quiet',
+        action="store_true",
+        default=False,
+        help='Discard subprocess output [default: "%(default)s"]'
+    )
+
+    parser.add_argument(
+        '-x',
+        '--x264-params',
+        dest='x264_params',
+        metavar='X264_PARAMS',
+        default='',
+        help='Parameters passed to x264 with -x264-params [default: "%(default)s"]'
+    )
+
+    parser.add_argument(
+        '-z',
+        '--zerolatency',
+        dest='zerolatency',
+        action="store_true",
+        default=False,
+        help='Tune for zero latency and disable input buffering [default: "%(default)s"]'
+    )
+
+    parser.add_argument(
+        '-n',
+        '--threads',
+        dest='threads',
+        metavar='THREADS',
+        type=int,
+        default=0,
+        help='Threads for ffmpeg to use, 0 lets ffmpeg decide [default: "%(default)s"]'
+    )
+
+    parser.add_argument(
+        '-P',
+        '--parallel',
+        dest='parallel',
+        metavar='PARALLEL',
+        type=int,
+        default=1,
+        help='Number of batch transcodes to run concurrently [default: "%(default)s"]'
+    )
+
+    parser.add_argument(
+        '-T',
+        '--threads-per-job',
+        dest='threads_per_job',
+        metavar='THREADS_PER_JOB',
+        type=int,
+        default=0,
+        help='Threads for each batch transcode, each is pinned to its own CPUs when set, 0 lets ffmpeg decide [default: "%(default)s"]'
+    )
+
+    parser.add_argument(
+        '-S',
+        '--stall-timeout',
+        dest='stall_timeout',
+        metavar='STALL_TIMEOUT',
+        type=int,
+        default=0,
+        help='Kill a transcode after this many seconds without ffmpeg progress, 0 disables [default: "%(default)s"]'
+    )
+
+    parser.add_argument(
+        '-V',
+        '--version-cache',
+        dest='version_cache',
+        action="store_true",
+        default=False,
+        help='Keep the ffmpeg version in %s between runs [default: "%%(default)s"]' % version_cache_file_name()
     )
 
     return parser
 
+def available_cpus():
+    # The CPUs this process may run on, None when the count is unknown.
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+def version_cache_file_name():
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache')))
+    return os.path.join(cache_dir, 'fftranscode', 'ver.json')
+
+def join_extra_args(argv):
+    # The value of --extra is ffmpeg arguments, so starts with a '-' which
+    # argparse would otherwise take for an option of its own.
+    joined = []
+    argv = iter(argv)
+
+    for arg in argv:
+        if arg in ('-e', '--extra'):
+            joined.append('--extra=%s' % next(argv, ''))
+        else:
+            joined.append(arg)
+
+    return joined
+
+def gen_slot_cpus(parallel, threads_per_job, logger):
+    # Give each slot a disjoint set of threads_per_job CPUs, a single ffmpeg
+    # does not scale across many cores so several pinned ones do better.
+    slot_cpus = [None] * parallel
+
+    if threads_per_job <= 0 or not hasattr(os, 'sched_setaffinity'):
+        return slot_cpus
+
+    cpus = sorted(os.sched_getaffinity(0))
+
+    if parallel * threads_per_job > len(cpus):
+        logger.warning('Not enough CPUs (%d) to pin %d transcodes of %d threads, not pinning.' % (len(cpus), parallel, threads_per_job))
+        return slot_cpus
+
+    for slot in range(parallel):
+        slot_cpus[slot] = set(cpus[slot * threads_per_job:(slot + 1) * threads_per_job])
+
+    return slot_cpus
+
 def verbose_logging(verbose = False):
     logging.getLogger().setLevel(logging.DEBUG if verbose else logging.INFO)
 
 class Fftranscode(Base):
-    def __init__(self, niced, input_file, output_file, codec_lib, profile, level, preset, crf, tune, extra, subprocess_out, interactive):
+    # ffmpeg versions keyed by the (path, mtime) of the ffmpeg binary, shared by
+    # every instance so a batch only probes the binary once.
+    version_cache = {}
+    version_cache_file = None
+
+    # One week of 1 seconds waits
+    max_waits = 604800
+    wait_interval = 1
+
+    def __init__(self, niced, input_file, output_file, codec_lib, profile, level, preset, crf, tune, extra, subprocess_out, interactive, quiet = False, threads = 0, stall_timeout = 0, zerolatency = False, x264_params = ''):
         super(Fftranscode, self).__init__()
         self.niced = niced
         self.input_file = input_file
@@ -166,40 +322,167 @@ class Fftranscode(Base):
         self.extra = extra
         self.subprocess_out = subprocess_out
         self.interactive = interactive
-        self.num_waits = 0
+        self.quiet = quiet
+        self.threads = threads
+        self.stall_timeout = stall_timeout
+        self.zerolatency = zerolatency
+        self.x264_params = x264_params
 
-        # One week of 1 seconds waits
-        self.max_waits = 604800
-        self.wait_interval = 1
+        # zerolatency can be combined with another tune, e.g. film,zerolatency
+        if self.zerolatency:
+            self.tune = 'zerolatency' if self.tune == '' else '%s,zerolatency' % self.tune
 
         self.exit_code = None
         self.sp = None
         self.ffmpeg_ver = None
+        self.args = None
+        self.static_args = None
+        self.subprocess_out_mode = 'wb'
+        self.cpus = None
+        self.timed_out = False
+        self.stalled = False
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.progress = {}
+        self.last_progress_ts = None
+        self.stderr_lines = collections.deque(maxlen = STDERR_LINES)
 
     def cancel_transcode(self, exit = True):
         self.logger.warning('Cancelling transcode.')
 
-        if self.sp is not None:
+        # A batch may cancel this from another thread before the subprocess
+        # has started, the flag stops it from being started at all.
+        with self.lock:
+            self.cancelled = True
+            sp = self.sp
+
+        if sp is not None:
             self.logger.warning('Subprocess still executing, sending Kill signal.')
-            self.sp.kill()
-            self.sp.wait()
+            sp.kill()
+            sp.wait()
         if exit:
             sys.exit(2)
 
-    def handle_subprocess(self):
-        if self.sp is None:
-            self.logger.error('There is no subprocess when there should be! Exiting.')
-            self.cancel_transcode()
+    def adjust_subprocess(self):
+        # Done from this process on the running subprocess rather than in a
+        # preexec_fn, as a preexec_fn forces a full fork() of this process where
+        # CPython can otherwise use vfork() to start the subprocess. ffmpeg
+        # starts its encoder threads later, so they inherit these settings.
+        try:
+            if self.niced == True:
+                os.setpriority(os.PRIO_PROCESS, self.sp.pid, min(os.getpriority(os.PRIO_PROCESS, 0) + 10, 19))
+            if self.cpus is not None:
+                os.sched_setaffinity(self.sp.pid, self.cpus)
+        except ProcessLookupError:
+            self.logger.debug('Subprocess exited before its priority and affinity were set.')
+
+    def read_progress(self, progress_fd):
+        # ffmpeg writes blocks of key=value lines, each ending with a
+        # progress=continue or progress=end line.
+        progress = {}
+
+        with os.fdopen(progress_fd, 'rb') as progress_pipe:
+            for line in progress_pipe:
+                key, _, value = line.decode('UTF-8', 'replace').strip().partition('=')
+                progress[key] = value
+                self.last_progress_ts = time.monotonic()
+
+                if key == 'progress':
+                    self.progress = progress
+                    self.logger.debug('Progress: frame=%s out_time=%s speed=%s' % (progress.get('frame'), progress.get('out_time'), progress.get('speed')))
+                    progress = {}
+
+    def read_stderr(self, stderr_pipe, outfile):
+        # Copies stderr to the subprocess output file, if there is one, and
+        # keeps its last lines. ffmpeg ends its status updates with a carriage
+        # return, so those are split into lines too. Every line, including a
+        # partial one, is capped to STDERR_LINE_LEN bytes.
+        partial = b''
+
+        try:
+            with stderr_pipe:
+                while True:
+                    chunk = stderr_pipe.read1(65536)
+                    if not chunk:
+                        break
+
+                    if outfile is not None:
+                        outfile.write(chunk)
+                        outfile.flush()
+
+                    lines = (partial + chunk).replace(b'\r', b'\n').split(b'\n')
+                    partial = lines.pop()[:STDERR_LINE_LEN]
+                    self.stderr_lines.extend(line[:STDERR_LINE_LEN] for line in lines if line != b'')
+        finally:
+            # The output file is handed over to this thread, which may outlive
+            # the transcode if something else holds the pipe open.
+            if outfile is not None:
+                outfile.close()
+
+        if partial != b'':
+            self.stderr_lines.append(partial)
+
+    def kill_timed_out(self):
+        # Runs in the watchdog timer thread once the maximum time has passed.
+        self.timed_out = True
+        self.sp.kill()
+
+    def watch_progress(self, exited):
+        # Runs in the stall watchdog thread, waking up when stall_timeout will
+        # have passed since the last progress update and killing ffmpeg if no
+        # newer update has arrived by then.
+        while True:
+            stalled_for = time.monotonic() - self.last_progress_ts
+
+            if stalled_for >= self.stall_timeout:
+                self.logger.error('No progress from subprocess for %d seconds, sending Kill signal.' % self.stall_timeout)
+                self.stalled = True
+                self.sp.kill()
+                return
+
+            if exited.wait(self.stall_timeout - stalled_for):
+                return
+
+    def wait_subprocess(self):
+        # Block in waitpid() until the subprocess exits, wait() with a timeout
+        # would poll instead. A SIGINT raises out of the wait via
+        # signal_handler, and watchdogs kill ffmpeg once it has run for the
+        # maximum time or stops making progress.
+        max_time = self.max_waits * self.wait_interval
+        self.timed_out = False
+        self.stalled = False
+
+        watchdog = threading.Timer(max_time, self.kill_timed_out)
+        watchdog.daemon = True
+        watchdog.start()
+
+        exited = threading.Event()
+
+        if self.stall_timeout > 0:
+            stall_watchdog = threading.Thread(target = self.watch_progress, args = (exited,), daemon = True)
+            stall_watchdog.start()
 
-        self.sp.poll()
+        try:
+            exit_code = self.sp.wait()
+        finally:
+            exited.set()
+            watchdog.cancel()
 
-        if self.sp.returncode is not None:
-            self.running = False
-            self.logger.info('Subprocess has exited. Exit code "%d".' % self.sp.returncode)
-            self.exit_code = self.sp.returncode
+        if self.timed_out:
+            raise Exception("Transcode took longer tham max %s seconds." % max_time)
+
+        if self.stalled:
+            raise Exception("Transcode made no progress for %s seconds." % self.stall_timeout)
+
+        return exit_code
 
     def gen_output_file_name(self):
-        file_name = "%s - ffmpeg:%s_c:%s_p:%s_l:%s_r:%s_f:%s" % (self.input_file[:-4], self.ffmpeg_ver, self.codec_lib, self.profile, self.level, self.preset, self.crf)
+        # Only probe ffmpeg for its version when it is needed for the file name.
+        if self.ffmpeg_ver is None:
+            self.get_ffencode_version()
+
+        base_name = os.path.splitext(self.input_file)[0]
+        file_name = "%s - ffmpeg:%s_c:%s_p:%s_l:%s_r:%s_f:%s" % (base_name, self.ffmpeg_ver, self.codec_lib, self.profile, self.level, self.preset, self.crf)
 
         if self.tune != '':
             file_name  += "_t:%s" % self.tune
@@ -210,13 +493,10 @@ class Fftranscode(Base):
 
         return file_name
 
-    def gen_transcode_args(self):
-        args = [ 'ffmpeg',
-                '-hide_banner',
-                '-n',
-                '-i',
-                self.input_file,
-                '-map',
+    def gen_static_args(self):
+        # The arguments between the input and output files only depend on the
+        # codec options, so they are generated once and reused.
+        args = [ '-map',
                 '0',
                 '-codec:a',
                 'copy',
@@ -234,69 +514,348 @@ class Fftranscode(Base):
                 self.crf
         ]
 
-        if self.niced == True:
-            args.insert(0, 'nice')
-
         if self.tune != '':
             args.append('-tune')
             args.append(self.tune)
 
+        if self.x264_params != '':
+            args.append('-x264-params')
+            args.append(self.x264_params)
+
         if self.extra != '':
-            for tok in self.extra.split():
-                args.append(tok)
+            # shlex keeps quoted arguments, e.g. filter graphs, as single tokens.
+            args.extend(shlex.split(self.extra))
+
+        if self.threads > 0:
+            args.append('-threads')
+            args.append(str(self.threads))
 
         if self.interactive == False:
             args.append('-nostdin')
 
+        return args
+
+    def gen_transcode_args(self):
+        if self.static_args is None:
+            self.static_args = self.gen_static_args()
+
         if self.output_file == '':
             self.output_file = self.gen_output_file_name()
 
-        args.append(self.output_file)
+        args = ['ffmpeg', '-hide_banner', '-n']
 
-        return args
+        # nobuffer is an input option, so it goes before the input file.
+        if self.zerolatency:
+            args.extend(['-fflags', '+nobuffer'])
+
+        return args + ['-i', self.input_file] + self.static_args + [self.output_file]
+
+    def load_version_cache(self):
+        # The cache is optional, a file that can not be read or has the wrong
+        # shape is treated as a cache miss.
+        try:
+            with open(self.version_cache_file) as f:
+                entries = json.load(f)
+
+            versions = {}
+            for path, mtime, ver in entries:
+                if not isinstance(path, str) or not isinstance(mtime, int) or not isinstance(ver, str):
+                    raise ValueError('Bad version cache entry: %r' % ([path, mtime, ver],))
+                versions[(path, mtime)] = ver
+        except (OSError, ValueError, TypeError) as e:
+            self.logger.debug('Unable to load version cache "%s": %s' % (self.version_cache_file, e))
+            return
+
+        Fftranscode.version_cache.update(versions)
+
+    def save_version_cache(self):
+        # Written to a temporary file and renamed over the cache, so a
+        # concurrent run never sees a partly written file.
+        try:
+            cache_dir = os.path.dirname(self.version_cache_file)
+            os.makedirs(cache_dir, exist_ok = True)
+            fd, tmp_name = tempfile.mkstemp(dir = cache_dir, prefix = '.ver.', suffix = '.json')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump([[path, mtime, ver] for (path, mtime), ver in Fftranscode.version_cache.items()], f)
+                os.replace(tmp_name, self.version_cache_file)
+            except BaseException:
+                os.unlink(tmp_name)
+                raise
+        except OSError as e:
+            self.logger.warning('Unable to save version cache "%s": %s' % (self.version_cache_file, e))
 
     def get_ffencode_version(self):
-        ffencode_pipe = subprocess.Popen(['ffmpeg', '-version'], stdout=subprocess.PIPE)
-        buff = ffencode_pipe.communicate()
+        ffmpeg_path = shutil.which('ffmpeg')
+        key = None
 
-        m = re.compile(b'^ffmpeg version (.+) Copyright').match(buff[0])
+        if ffmpeg_path is not None:
+            ffmpeg_path = os.path.realpath(ffmpeg_path)
+            key = (ffmpeg_path, os.stat(ffmpeg_path).st_mtime_ns)
 
-        if m:
-            # This gets ingested as a bytes array and needs to be encoded to UTF-8
-            # to avoid it being printed as b'...'
-            ver = m.groups()[0].decode('UTF-8')
-            self.logger.info("ffmpeg version: %s" % ver)
+            if key not in Fftranscode.version_cache and self.version_cache_file is not None:
+                self.load_version_cache()
+
+            if key in Fftranscode.version_cache:
+                self.ffmpeg_ver = Fftranscode.version_cache[key]
+                self.logger.info("ffmpeg version (cached): %s" % self.ffmpeg_ver)
+                return
+
+        # The version is on the first line, so the rest of the output is not
+        # read. stderr is discarded so it can not fill up a pipe and block.
+        with subprocess.Popen(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as ffencode_pipe:
+            first_line = ffencode_pipe.stdout.readline()
+            ffencode_pipe.stdout.close()
+            ffencode_pipe.wait()
+
+        m = FFMPEG_VER_RE.match(first_line)
+
+        if not m:
+            raise Exception("Unable to find ffmpeg version in: %s" % first_line)
+
+        # This gets ingested as a bytes array and needs to be encoded to UTF-8
+        # to avoid it being printed as b'...'
+        ver = m.groups()[0].decode('UTF-8')
+        self.logger.info("ffmpeg version: %s" % ver)
 
         self.ffmpeg_ver = ver
 
+        if key is not None:
+            Fftranscode.version_cache[key] = ver
+
+            if self.version_cache_file is not None:
+                self.save_version_cache()
+
     def transcode(self):
-        if self.subprocess_out != '-':
-            outfile = open(self.subprocess_out, 'w')
+        outfile = None
+
+        # The subprocess writes straight to the file descriptor, the file is
+        # opened in binary mode so no text translation is involved.
+        if self.quiet:
+            self.logger.info('Discarding subprocess output.')
+            stdout = subprocess.DEVNULL
+        elif self.subprocess_out != '-':
+            outfile = open(self.subprocess_out, self.subprocess_out_mode)
             self.logger.info('Opened file "%s" for subprocess output.' % self.subprocess_out)
+            stdout = outfile
         else:
             self.logger.info('Using stdout for subporcess output.')
-            outfile = None
+            stdout = None
 
-        # stderr is set to the same FD as stdout so the error output has context.
-        # Not all errors are informative, may need to dig through contextual output
-        # for approximate error cause.
+        # When the output is going to a terminal stderr is left alone so the
+        # ffmpeg status display still works. Otherwise stderr, where ffmpeg
+        # writes its log, is read back so its last lines can be logged if
+        # ffmpeg fails, and copied to the output file when there is one.
+        capture_stderr = stdout is not None
+        stderr = subprocess.PIPE if capture_stderr else None
 
-        self.get_ffencode_version()
-        args = self.gen_transcode_args()
-        self.logger.info('Starting Popen with args: %s' % args)
-        self.sp = subprocess.Popen(args, stderr=subprocess.STDOUT, stdout = outfile)
-        self.running = True
+        try:
+            if self.args is None:
+                self.args = self.gen_transcode_args()
+
+            args = self.args
+            # ffmpeg reports structured progress on its own pipe, the write end
+            # is inherited by the subprocess at the same descriptor number.
+            progress_r, progress_w = os.pipe()
+            args = args[:1] + ['-progress', 'pipe:%d' % progress_w] + args[1:]
+            self.logger.info('Starting Popen with args: %s' % args)
+
+            try:
+                with self.lock:
+                    if self.cancelled:
+                        raise Exception('Transcode of "%s" was cancelled before it started.' % self.input_file)
+
+                    self.sp = subprocess.Popen(args, stderr = stderr, stdout = stdout, pass_fds = (progress_w,))
+            except Exception:
+                os.close(progress_r)
+                raise
+            finally:
+                os.close(progress_w)
+
+            self.adjust_subprocess()
+
+            self.last_progress_ts = time.monotonic()
+            progress_reader = threading.Thread(target = self.read_progress, args = (progress_r,), daemon = True)
+            progress_reader.start()
+
+            if capture_stderr:
+                stderr_reader = threading.Thread(target = self.read_stderr, args = (self.sp.stderr, outfile), daemon = True)
+                stderr_reader.start()
+                outfile = None
+
+            # Like subprocess.run(), never leave ffmpeg running when the wait is
+            # interrupted, e.g. by a timeout or SIGINT.
+            try:
+                self.exit_code = self.wait_subprocess()
+            except BaseException:
+                self.sp.kill()
+                self.sp.wait()
+                raise
+            # Anything else holding the pipes open should not hold up the exit.
+            progress_reader.join(timeout = 1)
+            if capture_stderr:
+                stderr_reader.join(timeout = 1)
+        finally:
+            if outfile is not None:
+                outfile.close()
+
+        self.logger.info('Subprocess has exited. Exit code "%d".' % self.exit_code)
+
+        if self.exit_code != 0 and self.stderr_lines:
+            self.logger.error('Last %d lines of subprocess stderr:\n%s' % (len(self.stderr_lines), b'\n'.join(self.stderr_lines).decode('UTF-8', 'replace')))
 
-        while self.running == True and self.num_waits < self.max_waits:
-            self.num_waits += 1
-            time.sleep(self.wait_interval)
+        return self.exit_code
 
-            self.handle_subprocess()
+class BatchFftranscode(Base):
+    def __init__(self, niced, input_files, codec_lib, profile, level, preset, crf, tune, extra, subprocess_out, interactive, quiet = False, parallel = 1, threads_per_job = 0, stall_timeout = 0, threads = 0, zerolatency = False, x264_params = ''):
+        super(BatchFftranscode, self).__init__()
+        self.niced = niced
+        self.input_files = input_files
+        self.codec_lib = codec_lib
+        self.profile = profile
+        self.level = level
+        self.preset = preset
+        self.crf = crf
+        self.tune = tune
+        self.extra = extra
+        self.subprocess_out = subprocess_out
+        self.interactive = interactive
+        self.quiet = quiet
+        self.parallel = parallel
+        self.threads_per_job = threads_per_job
+        self.stall_timeout = stall_timeout
+        self.threads = threads
+        self.zerolatency = zerolatency
+        self.x264_params = x264_params
+
+        # Only one task is prepared ahead of the transcodes that are running.
+        self.tasks = queue.Queue(maxsize = 1)
+        self.exit_codes = {}
+        self.running = []
+        self.errors = []
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.ffmpeg_ver = None
+        self.static_args = None
 
-        if self.num_waits == self.max_waits:
-            raise Exception("Transcode took longer tham max %s seconds." % (self.max_waits * self.wait_interval))
+        # Each concurrent transcode takes a slot, which caps the number in
+        # flight to parallel.
+        self.slots = queue.Queue()
+        self.slot_cpus = gen_slot_cpus(self.parallel, self.threads_per_job, self.logger)
 
-        return self.exit_code
+        for slot in range(self.parallel):
+            self.slots.put(slot)
+
+    def cancel_transcode(self, exit = True):
+        self.logger.warning('Cancelling batch transcode.')
+
+        with self.lock:
+            self.cancelled = True
+            running = list(self.running)
+
+        for task in running:
+            task.cancel_transcode(exit = False)
+        if exit:
+            sys.exit(2)
+
+    def gen_tasks(self):
+        # Runs in the producer thread, preparing the arguments for the next
+        # input file while ffmpeg is busy with the current ones.
+        try:
+            for index, input_file in enumerate(self.input_files):
+                # Pinned transcodes use exactly as many threads as they have CPUs.
+                threads = self.threads_per_job if self.threads_per_job > 0 else self.threads
+                task = Fftranscode(self.niced, input_file, '', self.codec_lib, self.profile, self.level, self.preset, self.crf, self.tune, self.extra, self.subprocess_out, self.interactive, quiet = self.quiet, threads = threads, stall_timeout = self.stall_timeout, zerolatency = self.zerolatency, x264_params = self.x264_params)
+
+                # The ffmpeg binary and codec options are the same for the whole
+                # batch, so the version probe and static arguments are done once.
+                task.ffmpeg_ver = self.ffmpeg_ver
+                task.static_args = self.static_args
+                task.args = task.gen_transcode_args()
+                self.ffmpeg_ver = task.ffmpeg_ver
+                self.static_args = task.static_args
+
+                # The subprocess output file is shared by the whole batch.
+                task.subprocess_out_mode = 'ab'
+
+                self.tasks.put((index, task))
+        except Exception as e:
+            self.tasks.put(e)
+            return
+
+        self.tasks.put(None)
+
+    def run_task(self, index, task, slot):
+        try:
+            task.transcode()
+        except Exception as e:
+            self.logger.error('Transcode of "%s" failed: %s' % (task.input_file, e))
+            task.cancel_transcode(exit = False)
+            with self.lock:
+                self.errors.append(e)
+        finally:
+            with self.lock:
+                self.running.remove(task)
+                # Keyed by position, the same file may be listed more than once.
+                self.exit_codes[index] = task.exit_code
+            self.slots.put(slot)
+
+    def transcode(self):
+        if not self.quiet and self.subprocess_out != '-':
+            open(self.subprocess_out, 'wb').close()
+
+        producer = threading.Thread(target = self.gen_tasks, daemon = True)
+        producer.start()
+
+        while True:
+            task = self.tasks.get()
+
+            if task is None:
+                break
+            if isinstance(task, Exception):
+                raise task
+
+            index, task = task
+
+            # Blocks until one of the running transcodes has finished.
+            slot = self.slots.get()
+
+            if self.errors:
+                raise self.errors[0]
+
+            task.cpus = self.slot_cpus[slot]
+
+            with self.lock:
+                if self.cancelled:
+                    raise Exception('Batch transcode was cancelled.')
+
+                self.running.append(task)
+
+            self.logger.info('Transcoding "%s".' % task.input_file)
+            threading.Thread(target = self.run_task, args = (index, task, slot), daemon = True).start()
+
+        # Wait for the remaining transcodes by taking back every slot.
+        for _ in range(self.parallel):
+            self.slots.get()
+
+        producer.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        exit_codes = [(input_file, self.exit_codes.get(index)) for index, input_file in enumerate(self.input_files)]
+        failed = [exit_code for input_file, exit_code in exit_codes if exit_code != 0]
+
+        self.logger.info('Batch of %d transcodes has finished, %d failed. Exit codes: %s' % (len(exit_codes), len(failed), exit_codes))
+
+        if failed:
+            return failed[0]
+
+        return 0
+
+def read_input_list(input_list):
+    with open(input_list) as f:
+        return [line.strip() for line in f if line.strip() != '']
 
 def signal_handler(signum, stack_frame):
     raise Exception("Caught signal %d with stack frame: %s" % (signum, stack_frame))
@@ -304,23 +863,60 @@ def signal_handler(signum, stack_frame):
 if __name__ == '__main__':
     parser = command_line_parser()
 
-    (options, args) = parser.parse_args()
+    options = parser.parse_args(join_extra_args(sys.argv[1:]))
 
     verbose_logging(options.verbose)
 
-    if len(options.input_file) > 0:
-        try:
-            fftranscode = Fftranscode(not options.not_nice, options.input_file, options.output_file, options.codec, options.profile, options.level, options.preset, options.crf, options.tune, options.extra, options.subprocess_out_file, options.interactive)
-            signal.signal(signal.SIGINT, signal_handler)
-            print(fftranscode)
-            exit_code = fftranscode.transcode()
-        except Exception as e:
-            print(e)
-            fftranscode.logger.error('Exception: %s', type(e))
-            fftranscode.cancel_transcode(exit = False)
-            raise
-    else:
+    if options.version_cache:
+        Fftranscode.version_cache_file = version_cache_file_name()
+
+    input_files = list(options.input_files)
+
+    if options.input_list != '':
+        input_files.extend(read_input_list(options.input_list))
+
+    if options.parallel < 1:
+        print('ERROR: parallel must be at least 1.')
+        sys.exit(1)
+
+    cpus = available_cpus()
+
+    if options.threads < 0 or (cpus is not None and options.threads > cpus):
+        print('ERROR: threads must be between 0 and the number of CPUs (%s).' % cpus)
+        sys.exit(1)
+
+    if options.threads_per_job < 0:
+        print('ERROR: threads per job must be at least 0.')
+        sys.exit(1)
+
+    if len(input_files) > 1 and options.output_file != '':
+        print('ERROR: output file can not be set when transcoding multiple input files.')
+        sys.exit(1)
+
+    if len(input_files) == 0:
         print('ERROR: input file must be set.')
         sys.exit(1)
 
+    fftranscode = None
+
+    try:
+        if len(input_files) > 1:
+            fftranscode = BatchFftranscode(not options.not_nice, input_files, options.codec, options.profile, options.level, options.preset, options.crf, options.tune, options.extra, options.subprocess_out_file, options.interactive, quiet = options.quiet, parallel = options.parallel, threads_per_job = options.threads_per_job, stall_timeout = options.stall_timeout, threads = options.threads, zerolatency = options.zerolatency, x264_params = options.x264_params)
+        else:
+            # A single transcode is pinned and threaded the same way as each
+            # one in a batch, parallel has no other transcodes to run.
+            threads = options.threads_per_job if options.threads_per_job > 0 else options.threads
+            fftranscode = Fftranscode(not options.not_nice, input_files[0], options.output_file, options.codec, options.profile, options.level, options.preset, options.crf, options.tune, options.extra, options.subprocess_out_file, options.interactive, quiet = options.quiet, threads = threads, stall_timeout = options.stall_timeout, zerolatency = options.zerolatency, x264_params = options.x264_params)
+            fftranscode.cpus = gen_slot_cpus(1, options.threads_per_job, fftranscode.logger)[0]
+        signal.signal(signal.SIGINT, signal_handler)
+        print(fftranscode)
+        exit_code = fftranscode.transcode()
+    except Exception:
+        logger = logging.getLogger('fftranscode')
+        if fftranscode is not None:
+            logger = fftranscode.logger
+            fftranscode.cancel_transcode(exit = False)
+        logger.exception('Transcode failed')
+        sys.exit(2)
+
     sys.exit(exit_code)